@@ -4,15 +4,23 @@ import sys
 import os
 import time
 import traceback
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
 import re
 
-FREQ_REGEX = re.compile(r"^cpu MHz\s*:\s*(\d+)\.")
-# cpu<N>
-REGEX_VALID_CORE_NAME = re.compile(r"^cpu\d+$")
-REGEX_VALID_CORE_NAME_EXCLUDE_CPU0 = re.compile(r"^cpu[1-9]\d*$")
+SYSFS_CPU = "/sys/devices/system/cpu"
+FREQ_REGEX = re.compile(rb"^cpu MHz\s*:\s*(\d+)\.", re.MULTILINE)
+
+BOOL_TEXT_MAP = {"1": True, "on": True, "0": False, "off": False}
 
 DEBUG = False
+# Per core sysfs accesses are only done in parallel above this many cores, since starting threads has a cost too
+PARALLEL_IO_THRESHOLD = 8
+# How long to wait for the current CPU frequencies to reach newly set limits (in seconds)
+FREQ_WAIT_TIMEOUT = 0.1
+FREQ_TOLERANCE_MHZ = 10
+# The core status does not change during a single run (unless we change it ourselves), so it is cached
+_core_status_cache: Optional[list[tuple[str, bool]]] = None
 
 
 def read_file(path: str) -> str:
@@ -24,25 +32,57 @@ def read_file(path: str) -> str:
     return contents
 
 
-def write_file(path: str, contents: str) -> None:
+def read_file_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        contents = f.read()
+
     if DEBUG:
-        print(f"[DEBUG] File write '{contents}' -> {path}")
+        print(f"[DEBUG] File read {repr(contents)} from {path}")
+    return contents
+
+
+def _write_sysfs_raw(path: str, data: bytes) -> None:
+    """
+    Writes data via a raw file descriptor, which skips the overhead of creating a Python file object
+    """
+    if DEBUG:
+        print(f"[DEBUG] File write {repr(data)} -> {path}")
+
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
 
-    with open(path, "w") as f:
-        f.write(str(contents))
 
 def write_bool_to_file(path: str, value: bool) -> None:
-    write_file(path, "1" if value else "0")
+    _write_sysfs_raw(path, b"1" if value else b"0")
+
+
+T = TypeVar("T")
+
+
+def map_io(function: Callable[[str], T], path_list: list[str]) -> list[T]:
+    """
+    Calls function for every path. Reading sysfs files can block for quite a while, so this is done using threads on bigger systems
+    """
+    if len(path_list) <= PARALLEL_IO_THRESHOLD:
+        return [function(path) for path in path_list]
+
+    with ThreadPoolExecutor(max_workers=min(32, len(path_list))) as executor:
+        return list(executor.map(function, path_list))
+
+
+def _invalidate_core_status_cache() -> None:
+    global _core_status_cache
+    _core_status_cache = None
 
 
 def parse_bool(boolean_as_text: str) -> bool:
-    value = boolean_as_text.strip()
-    if value in ["1", "on"]:
-        return True
-    elif value in ["0", "off"]:
-        return False
-    else:
-        raise Exception(f"Can not parse as boolean: '{boolean_as_text}'")
+    try:
+        return BOOL_TEXT_MAP[boolean_as_text.strip()]
+    except KeyError:
+        raise Exception(f"Can not parse as boolean: '{boolean_as_text}'") from None
 
 
 class CpuManager:
@@ -51,80 +91,150 @@ class CpuManager:
 
     @staticmethod
     def is_boost_enabled() -> bool:
-        text = read_file("/sys/devices/system/cpu/cpufreq/boost")
+        text = read_file(SYSFS_CPU + "/cpufreq/boost")
         return parse_bool(text)
 
     @staticmethod
     def set_boost(enabled: bool) -> None:
-        write_bool_to_file("/sys/devices/system/cpu/cpufreq/boost", enabled)
+        write_bool_to_file(SYSFS_CPU + "/cpufreq/boost", enabled)
 
     @staticmethod
     def is_smt_enabled() -> bool:
-        text = read_file("/sys/devices/system/cpu/smt/active")
+        text = read_file(SYSFS_CPU + "/smt/active")
         return parse_bool(text)
 
     @staticmethod
     def set_smt(enabled: bool) -> None:
-        value = "on" if enabled else "off"
-        write_file("/sys/devices/system/cpu/smt/control", value)
+        # Toggling SMT changes which cores are online
+        _invalidate_core_status_cache()
+        value = b"on" if enabled else b"off"
+        _write_sysfs_raw(SYSFS_CPU + "/smt/control", value)
 
     @staticmethod
     def get_freq_span() -> tuple[int, int]:
         """
-        @TODO
-        Sadly, this approach requires root permissions, maybe revert to parsing /proc/cpuinfo
+        Parses /proc/cpuinfo, since it contains the frequencies of all cores and does not require root permissions.
+        Some architectures do not list the frequencies there, so the per core sysfs files are used as a fallback
+        """
+        freq_list = [int(x) for x in FREQ_REGEX.findall(read_file_bytes("/proc/cpuinfo"))]
+        if freq_list:
+            return (min(freq_list), max(freq_list))
+        else:
+            return CpuManager.get_freq_span_sysfs()
+
+    @staticmethod
+    def get_freq_span_sysfs() -> tuple[int, int]:
+        """
+        Sadly, this approach requires root permissions
         """
         min_freq = 1000000
         max_freq = 0
-        for core_num, is_enabled in enumerate(CpuManager.get_core_status()):
-            if is_enabled:
-                freq_path = f"/sys/devices/system/cpu/cpu{core_num}/cpufreq/cpuinfo_cur_freq"
-                text = read_file(freq_path)
-                freq = int(text) / 1000
-                min_freq = min(min_freq, freq)
-                max_freq = max(max_freq, freq)
+        freq_path_list = [cpufreq_dir + "/cpuinfo_cur_freq" for cpufreq_dir in CpuManager.get_online_cpufreq_dirs()]
+        for text in map_io(read_file, freq_path_list):
+            freq = int(text) // 1000
+            min_freq = min(min_freq, freq)
+            max_freq = max(max_freq, freq)
 
         return (min_freq, max_freq)
 
     @staticmethod
     def get_available_freq_list() -> list[int]:
-        freq_list = read_file("/sys/devices/system/cpu/cpu0/cpufreq/scaling_available_frequencies").split()
-        # convert strings to ints. Convert hertz into kilohertz
-        freq_list = [int(x) / 1000 for x in freq_list if x]
-        return sorted(freq_list)
+        freq_list = read_file(SYSFS_CPU + "/cpu0/cpufreq/scaling_available_frequencies").split()
+        # convert strings to ints. Convert kilohertz into megahertz
+        return sorted(int(x) // 1000 for x in freq_list if x)
 
     @staticmethod
-    def set_min_freq(freq_in_mhz: int):
-        for core_num, is_enabled in enumerate(CpuManager.get_core_status()):
-            if is_enabled:
-                freq_path = f"/sys/devices/system/cpu/cpu{core_num}/cpufreq/scaling_min_freq"
-                write_file(freq_path, str(freq_in_mhz * 1000))
+    def set_min_and_max_freq(min_freq_in_mhz: Optional[int], max_freq_in_mhz: Optional[int]) -> None:
+        """
+        Sets both limits in a single pass over the online cores. A limit that is None is not changed.
+        A failed write does not stop the other writes, the failures are reported afterwards
+        """
+        # (limit name, file name, payload)
+        write_list = []
+        if min_freq_in_mhz:
+            write_list.append(("minimum", "/scaling_min_freq", str(min_freq_in_mhz * 1000).encode()))
+        if max_freq_in_mhz:
+            write_list.append(("maximum", "/scaling_max_freq", str(max_freq_in_mhz * 1000).encode()))
+            if min_freq_in_mhz:
+                # The kernel may reject a minimum above the current maximum, so in that case the maximum is raised first
+                try:
+                    current_max_freq = int(read_file(SYSFS_CPU + "/cpu0/cpufreq/scaling_max_freq"))
+                    if min_freq_in_mhz * 1000 > current_max_freq:
+                        write_list.reverse()
+                except (OSError, ValueError):
+                    pass
+
+        def update_core(cpufreq_dir: str) -> list[tuple[str, OSError]]:
+            error_list = []
+            for limit_name, file_name, payload in write_list:
+                try:
+                    _write_sysfs_raw(cpufreq_dir + file_name, payload)
+                except OSError as e:
+                    error_list.append((limit_name, e))
+            return error_list
+
+        error_list = [error for core_error_list in map_io(update_core, CpuManager.get_online_cpufreq_dirs())
+                      for error in core_error_list]
+        if error_list:
+            message_list = []
+            for limit_name, _, _ in write_list:
+                limit_error_list = [e for name, e in error_list if name == limit_name]
+                if limit_error_list:
+                    message_list.append(f"Failed setting the {limit_name} frequency on {len(limit_error_list)} core(s): {limit_error_list[0]}")
+            raise Exception("\n".join(message_list)) from error_list[0][1]
 
     @staticmethod
-    def set_max_freq(freq_in_mhz: int):
-        for core_num, is_enabled in enumerate(CpuManager.get_core_status()):
-            if is_enabled:
-                freq_path = f"/sys/devices/system/cpu/cpu{core_num}/cpufreq/scaling_max_freq"
-                write_file(freq_path, str(freq_in_mhz * 1000))
+    def wait_for_freq_limits(min_freq_in_mhz: Optional[int], max_freq_in_mhz: Optional[int]) -> None:
+        """
+        Waits (at most FREQ_WAIT_TIMEOUT seconds) until the current frequency of all cores is within the new limits, so that it is up to date when shown afterwards
+        """
+        # The reported frequencies are truncated to whole MHz and are not exact, so a core at a limit can look slightly outside of it
+        lower_limit = (min_freq_in_mhz or 0) - FREQ_TOLERANCE_MHZ
+        upper_limit = (max_freq_in_mhz or sys.maxsize) + FREQ_TOLERANCE_MHZ
+        deadline = time.monotonic() + FREQ_WAIT_TIMEOUT
+        while True:
+            try:
+                freq_min, freq_max = CpuManager.get_freq_span()
+                if lower_limit <= freq_min and freq_max <= upper_limit:
+                    return
+            except (OSError, ValueError):
+                # Can not verify the values, so just give them the whole time to update
+                pass
+
+            remaining_time = deadline - time.monotonic()
+            if remaining_time <= 0:
+                return
+            time.sleep(min(0.005, remaining_time))
 
     @staticmethod
     def get_core_status() -> list[bool]:
-        result = []
-        try:
-            # for some reason cpu0 did not have a online attribute
-            # TODO: maybe investigate
-            # For low, let's just assume it is always online
-            result.append(True)
-
-            for index in range(1, 100000):
-                # If it has more that that many cores, there is probably some error or something
-                text = read_file(f"/sys/devices/system/cpu/cpu{index}/online")
-                is_online = parse_bool(text)
-                result.append(is_online)
-            raise Exception("I am pertty sure you do not have that many cores ;)")
-        except FileNotFoundError:
-            # no more CPUs exist
-            pass
+        return [is_online for _, is_online in CpuManager.get_core_dir_status()]
+
+    @staticmethod
+    def get_core_dir_status() -> list[tuple[str, bool]]:
+        """
+        Returns (core_dir, is_online) for every core, sorted by the core number.
+        The core numbers may have gaps, so the position in the list is not necessarily the core number
+        """
+        global _core_status_cache
+        if _core_status_cache is not None:
+            return _core_status_cache
+
+        # for some reason cpu0 did not have a online attribute
+        # TODO: maybe investigate
+        # For low, let's just assume it is always online
+        result = [(SYSFS_CPU + "/cpu0", True)]
+
+        def is_core_online(core_dir: str) -> bool:
+            try:
+                return parse_bool(read_file(core_dir + "/online"))
+            except FileNotFoundError:
+                # Kernels without CPU hotplug support have no online files, so the core can not be offline
+                return True
+
+        core_dir_list = CpuManager.get_cpu_core_dirs(exclude_cpu0=True)
+        result += zip(core_dir_list, map_io(is_core_online, core_dir_list))
+        _core_status_cache = result
         return result
 
     @staticmethod
@@ -132,26 +242,41 @@ class CpuManager:
         if target < 1:
             raise Exception(f"Invalid CPU core target: {target}. Needs to be 1 or higher")
 
+        # This changes which cores are online
+        _invalidate_core_status_cache()
+
         # CPU indices start at 0, but CPU0 can/should probably not be disabled :)
-        for index in range(1, 100000):
-            # If it has more that that many cores, there is probably some error or something
-            try:
-                value = "1" if index < target else "0"
-                write_file(f"/sys/devices/system/cpu/cpu{index}/online", value)
-            except FileNotFoundError:
-                if index < target:
-                    raise Exception(f"Can't reach target of {target} cores, because your system only has {index} virtual cores")
-                return
-        raise Exception("I am pertty sure you do not have that many cores ;)")
+        core_dir_list = CpuManager.get_cpu_core_dirs(exclude_cpu0=True)
+        core_count = len(core_dir_list) + 1
+        if core_count < target:
+            raise Exception(f"Can't reach target of {target} cores, because your system only has {core_count} virtual cores")
+
+        for index, core_dir in enumerate(core_dir_list, start=1):
+            write_bool_to_file(core_dir + "/online", index < target)
+
+    @staticmethod
+    def is_cpu_core_name(name: str, exclude_cpu0: bool = False) -> bool:
+        """
+        Checks if name has the format cpu<N>, where <N> is a number. Plain string operations are faster than a regex here
+        """
+        return name.startswith("cpu") and name[3:].isdigit() and not (exclude_cpu0 and name == "cpu0")
 
     @staticmethod
     def get_cpu_core_dirs(exclude_cpu0: bool = False) -> list[str]:
         """
-        Returns a list of directories matching /sys/devices/system/cpu/cpu<N>, where <N> is a number
+        Returns a list of directories matching /sys/devices/system/cpu/cpu<N>, where <N> is a number. It is sorted by <N>
         """
-        root = "/sys/devices/system/cpu/"
-        regex = REGEX_VALID_CORE_NAME_EXCLUDE_CPU0 if exclude_cpu0 else REGEX_VALID_CORE_NAME
-        return [os.path.join(root, x) for x in os.listdir(root) if regex.match(x)]
+        with os.scandir(SYSFS_CPU) as entry_iterator:
+            core_dir_list = [entry.path for entry in entry_iterator
+                             if CpuManager.is_cpu_core_name(entry.name, exclude_cpu0) and entry.is_dir(follow_symlinks=False)]
+        return sorted(core_dir_list, key=lambda path: int(os.path.basename(path)[3:]))
+
+    @staticmethod
+    def get_online_cpufreq_dirs() -> list[str]:
+        """
+        Returns the /sys/devices/system/cpu/cpu<N>/cpufreq directories of all online cores
+        """
+        return [core_dir + "/cpufreq" for core_dir, is_online in CpuManager.get_core_dir_status() if is_online]
 
 
 
@@ -182,40 +307,48 @@ def subcommand_info(args) -> int:
     def bool_to_str(x: bool) -> str:
         return "enabled" if x else "disabled"
 
-    def show_boost():
+    def format_boost() -> str:
         is_boost_on = CpuManager.is_boost_enabled()
         pretty_boost = bool_to_str(is_boost_on)
-        print(f"Boost          : {pretty_boost}")
+        return f"Boost          : {pretty_boost}"
 
-    def show_smt():
+    def format_smt() -> str:
         is_smt_on = CpuManager.is_smt_enabled()
         pretty_smt = bool_to_str(is_smt_on)
-        print(f"SMT            : {pretty_smt}")
+        return f"SMT            : {pretty_smt}"
 
-    def show_core_count():
+    def format_core_count() -> str:
         core_status_list = CpuManager.get_core_status()
-        online_count = len([x for x in core_status_list if x])
+        online_count = core_status_list.count(True)
         total_count = len(core_status_list)
-        print(f"Cores          : {online_count} / {total_count}")
+        return f"Cores          : {online_count} / {total_count}"
 
-    def show_freq():
+    def format_freq() -> str:
         freq_min, freq_max = CpuManager.get_freq_span()
-        pretty_freq = f"{int(freq_min)}"
+        pretty_freq = f"{freq_min}"
         if freq_min != freq_max:
-            pretty_freq += f" - {int(freq_max)}"
-        print(f"Current freq   : {pretty_freq} MHz")
+            pretty_freq += f" - {freq_max}"
+        return f"Current freq   : {pretty_freq} MHz"
 
-    def show_available_freq():
+    def format_available_freq() -> str:
         freq_list = CpuManager.get_available_freq_list()
-        pretty_freq = ", ".join([f"{int(x)} MHz" for x in freq_list])
-        print(f"Available freq : {pretty_freq}")
+        pretty_freq = ", ".join(f"{x} MHz" for x in freq_list)
+        return f"Available freq : {pretty_freq}"
+
+    info_list = [
+        (format_core_count, "Failed to get CPU core count"),
+        (format_smt, "Failed to get SMT status"),
+        (format_boost, "Failed to get CPU boost"),
+        (format_freq, "Failed to get CPU frequency"),
+        (format_available_freq, "Failed to get available CPU frequencies"),
+    ]
+    # The values are read in parallel, since reading sysfs files can be slow. They are printed in the original order
+    with ThreadPoolExecutor(max_workers=len(info_list)) as executor:
+        future_list = [(executor.submit(function), error_message) for function, error_message in info_list]
 
     error_handler = ErrorHandler(args.verbose)
-    error_handler.try_fn(show_core_count, "Failed to get CPU core count")
-    error_handler.try_fn(show_smt, "Failed to get SMT status")
-    error_handler.try_fn(show_boost, "Failed to get CPU boost")
-    error_handler.try_fn(show_freq, "Failed to get CPU frequency")
-    error_handler.try_fn(show_available_freq, "Failed to get available CPU frequencies")
+    for future, error_message in future_list:
+        error_handler.try_fn(lambda: print(future.result()), error_message)
     return error_handler.get_exit_code()
 
 
@@ -235,17 +368,18 @@ def subcommand_set(args) -> int:
     if args.boost != None:
         error_handler.try_fn(lambda: CpuManager.set_boost(args.boost), "Failed updating boost")
     
-    if args.min_freq:
-        min_freq = int(args.min_freq * 1000)
-        error_handler.try_fn(lambda: CpuManager.set_min_freq(min_freq), "Failed setting minimum frequency")
+    if args.min_freq or args.max_freq:
+        min_freq = int(args.min_freq * 1000) if args.min_freq else None
+        max_freq = int(args.max_freq * 1000) if args.max_freq else None
+        limit_names = "/".join(name for name, freq in [("minimum", min_freq), ("maximum", max_freq)] if freq)
 
-    if args.max_freq:
-        max_freq = int(args.max_freq * 1000)
-        error_handler.try_fn(lambda: CpuManager.set_max_freq(max_freq), "Failed setting maximum frequency")
+        def set_freq_limits() -> bool:
+            CpuManager.set_min_and_max_freq(min_freq, max_freq)
+            return True
 
-    if args.min_freq or args.max_freq:
-        # Wait a bit to give the settings time to update
-        time.sleep(0.1)
+        if error_handler.try_fn(set_freq_limits, f"Failed setting {limit_names} frequency"):
+            # Only wait if the limits were applied, otherwise the frequencies may never reach them
+            error_handler.try_fn(lambda: CpuManager.wait_for_freq_limits(min_freq, max_freq), "Failed waiting for the new CPU frequency")
 
     # Show the new values, so that I can see if the opperation succeeded
     if subcommand_info(args) != 0: